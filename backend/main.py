@@ -1,39 +1,143 @@
 import asyncio
-import threading
 import time
 import numpy as np
 import os
+# OpenMP sizes its pool once at load time, so set it before CTranslate2 is imported
+# (the spawned transcription worker inherits this environment)
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count() or 4))
+# Keep each OpenMP thread on one core (CTranslate2 ships Intel OpenMP) to keep L2 warm
+os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from faster_whisper import WhisperModel
 import scipy.io.wavfile as wavfile
+import orjson
+
+try:
+    from numba import njit, types
+except ImportError:  # Optional: fall back to NumPy reductions
+    njit = None
 
 # --- CONFIG ---
 SAMPLE_RATE = 16000
 WINDOW_SECONDS = 2.5
 STRIDE_SECONDS = 0.5
 MODEL_SIZE = "small.en"
-BEAM_SIZE = 5
+# "faster-whisper" (CTranslate2) or "whispercpp" (pywhispercpp, GGML weights)
+ASR_BACKEND = "faster-whisper"
+# ggml-small.en is published as q5_1 / q8_0 (there is no q5_0 build)
+WHISPERCPP_MODEL = "small.en-q5_1"
+# CTranslate2 has no int4 weight type on CPU; int8 is its smallest.
+COMPUTE_TYPE = "int8"
+CPU_THREADS = os.cpu_count() or 4
+BEAM_SIZE = 5 # Final commits only; interim windows decode greedily
+SILENCE_THRESHOLD = 0.01
+TAIL_SILENCE_THRESHOLD = 0.005 # New audio this quiet can't change the interim text
+SILENCE_BUCKET_SECONDS = 0.25 # Granularity of the per-connection peak tracker
+
+# Shared ring layout: int64 absolute write counter, then the float32 samples
+RING_HEADER_BYTES = 8
+
+# int16 PCM -> [-1, 1) float32 scale, kept in float32 so the multiply never upcasts
+INV_32768 = np.float32(1.0 / 32768.0)
+
+# --- KERNELS ---
+if njit is not None:
+    # Eager signature: compiled (or loaded from cache) at import, not on first call.
+    # The source is typed read-only so websocket bytes can be viewed without a copy.
+    @njit(
+        types.float32(types.Array(types.int16, 1, "C", readonly=True), types.float32[::1], types.float32),
+        cache=True, fastmath=True
+    )
+    def _ingest(src, dst, inv_scale):
+        # One pass: read int16 once, write scaled float32 once, return peak |x|
+        m = np.float32(0.0)
+        for i in range(src.shape[0]):
+            v = src[i] * inv_scale
+            dst[i] = v
+            a = v if v >= 0 else -v
+            if a > m:
+                m = a
+        return m
+else:
+    def _ingest(src, dst, inv_scale):
+        np.multiply(src, inv_scale, out=dst, dtype=np.float32)
+        return float(np.max(np.abs(dst))) if len(dst) else 0.0
 
 # --- GLOBAL STATE ---
-model = None
+model = None # Only set inside the transcription worker process
 is_running = False
 debug_wav_saved = False
 
 def load_model():
     global model
+    if ASR_BACKEND == "whispercpp":
+        # Optional dependency: only needed when this backend is selected
+        from pywhispercpp.model import Model
+        print(f"[BACKEND] Loading whisper.cpp ({WHISPERCPP_MODEL})...")
+        model = Model(
+            WHISPERCPP_MODEL,
+            params_sampling_strategy=1, # Beam search; beam_size=1 is greedy
+            n_threads=CPU_THREADS,
+            print_realtime=False,
+            print_progress=False
+        )
+        print("[BACKEND] Model loaded.")
+        return
+
+    # Imported here so only the worker process loads CTranslate2 and its OpenMP runtime
+    from faster_whisper import WhisperModel
     print(f"[BACKEND] Loading Faster-Whisper ({MODEL_SIZE})...")
     # Step 6: Use exact settings
-    model = WhisperModel(MODEL_SIZE, device="cpu", compute_type="int8")
+    model = WhisperModel(
+        MODEL_SIZE,
+        device="cpu",
+        compute_type=COMPUTE_TYPE,
+        cpu_threads=CPU_THREADS,
+        num_workers=1
+    )
     print("[BACKEND] Model loaded.")
 
+# One dedicated worker process: the model's OpenMP pool gets its own cores and
+# GIL, away from the event loop, and concurrent decodes can't fight over it.
+# Audio reaches it through per-connection shared memory, not pickled arrays.
+def make_executor():
+    return ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=load_model
+    )
+
+TRANSCRIBE_EXEC = make_executor()
+
+def restart_executor(broken):
+    # A dead worker (OOM, native fault) breaks the pool for good: replace it.
+    # Several connections may notice at once; only the first one swaps it.
+    # The warm-up is queued first, so the model load and first-use cost land
+    # on it rather than on a live window.
+    global TRANSCRIBE_EXEC
+    if TRANSCRIBE_EXEC is broken:
+        print("[BACKEND] Transcription worker died, restarting it")
+        broken.shutdown(wait=False, cancel_futures=True)
+        TRANSCRIBE_EXEC = make_executor()
+        TRANSCRIBE_EXEC.submit(warm_up)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup
-    threading.Thread(target=load_model, daemon=True).start()
+    # Startup: the first job spawns the worker, which loads the model in its
+    # initializer, so no connection is accepted before the model is ready.
+    # The job itself is a warm-up: first-call kernel selection and
+    # allocations happen here instead of on the first live window
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(TRANSCRIBE_EXEC, warm_up)
+    print("[BACKEND] Model warmed up.")
     yield
-    # Shutdown logic (if needed) can go here
+    # Shutdown
+    TRANSCRIBE_EXEC.shutdown(wait=False, cancel_futures=True)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -60,29 +164,68 @@ async def stop_capture():
     print("[BACKEND] Capture stopped")
     return {"status": "stopped"}
 
-# Synchronization primitives
-buffer_lock = asyncio.Lock()
-
-
-
-
-def transcribe_sync(audio_data):
+def transcribe_sync(audio_data, beam_size=1):
     if model is None: return ""
     
+    if ASR_BACKEND == "whispercpp":
+        segments = model.transcribe(
+            audio_data,
+            language="en",
+            translate=False,
+            beam_search={"beam_size": beam_size, "patience": -1.0},
+            temperature=0.0,
+            temperature_inc=0.0 # No fallback re-decodes at higher temperatures
+        )
+        return " ".join(s.text for s in segments).strip()
+    
     # Step 3, 4, 6: Strict Settings
     segments, _ = model.transcribe(
         audio_data, 
-        beam_size=BEAM_SIZE,
+        beam_size=beam_size,
         language="en",          # Explicit Language
         task="transcribe",      # Explicit Task
-        temperature=0.0,        # No random sampling
+        temperature=[0.0],      # No random sampling, no fallback ladder
+        compression_ratio_threshold=2.4,
+        log_prob_threshold=-1.0,
+        no_speech_threshold=0.6,
         vad_filter=False,       # Disable VAD optimization
         condition_on_previous_text=False, # Prevent cascading failures
-        word_timestamps=True    # Per requirements
+        word_timestamps=False   # Alignment pass unused: only text is sent
     )
     
-    text = " ".join([s.text for s in segments]).strip()
-    return text
+    # segments is lazy: decoding happens as the join consumes it
+    return " ".join(s.text for s in segments).strip()
+
+def transcribe_shared(shm_name, capacity, start, count, beam_size=1):
+    # Runs in the worker: copy the window (absolute sample `start`) out of the
+    # connection's shared ring and detach before decoding, so no view outlives
+    # the mapping. Only the copy can be torn, so returns (text, torn).
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        written = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+        ring = np.ndarray((capacity,), dtype=np.float32, buffer=shm.buf, offset=RING_HEADER_BYTES)
+        lo = start % capacity
+        hi = lo + count
+        if hi <= capacity:
+            audio = ring[lo:hi].copy()
+        else:
+            audio = np.concatenate((ring[lo:], ring[: hi - capacity]))
+        # The writer bumps the counter before it writes, so a lap during the
+        # copy always shows up here
+        torn = int(written[0]) - capacity > start
+        del written, ring
+    finally:
+        shm.close()
+    if torn:
+        return "", True
+    return transcribe_sync(audio, beam_size), False
+
+def warm_up():
+    # Runs in the worker: exercise both decode configurations (greedy interim,
+    # beam-search commit) so neither pays first-use cost on a live window
+    silence = np.zeros(SAMPLE_RATE, dtype=np.float32)
+    transcribe_sync(silence)
+    transcribe_sync(silence, BEAM_SIZE)
 
 @app.websocket("/ws/captions")
 async def websocket_endpoint(websocket: WebSocket):
@@ -91,98 +234,198 @@ async def websocket_endpoint(websocket: WebSocket):
     print("[BACKEND] WebSocket connected")
 
     # Shared State for this connection
-    # Pre-allocate buffer for ~10 seconds
-    buffer_capacity = int(SAMPLE_RATE * 10)
-    audio_buffer = np.zeros(buffer_capacity, dtype=np.float32)
+    # Pre-allocate ring buffer for 3x window (7.5 s, 480 KB: fits in L2).
+    # A window is only at risk until the worker copies it: an interim has ~5 s
+    # of queueing headroom, a beam commit (window ended ~2.5 s earlier) ~3 s.
+    buffer_capacity = int(SAMPLE_RATE * WINDOW_SECONDS * 3)
+    # Backed by shared memory so windows reach the worker without pickling
+    shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_BYTES + buffer_capacity * 4)
+    ring_written = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+    audio_buffer = np.ndarray(
+        (buffer_capacity,), dtype=np.float32, buffer=shm.buf, offset=RING_HEADER_BYTES
+    )
+    ring_written[0] = 0
+    audio_buffer[:] = 0
     
     # Mutual state container
     state = {
-        "buffer_ptr": 0,
-        "total_samples": 0
+        "total_samples": 0   # Absolute samples written; ring index is this mod capacity
     }
     
+    # Running |x| peak per SILENCE_BUCKET_SECONDS of audio, updated as chunks
+    # arrive, so the silence check never rescans the whole window
+    bucket_samples = int(SAMPLE_RATE * SILENCE_BUCKET_SECONDS)
+    n_buckets = int(np.ceil(WINDOW_SECONDS / SILENCE_BUCKET_SECONDS)) + 1
+    bucket_max = np.zeros(n_buckets, dtype=np.float32)
+    
+    # No lock: the receiver is the only writer and the transcriber the only
+    # reader, both on the event loop, and neither awaits mid-write/snapshot.
+    # The worker checks the shared write counter after copying a window.
     stop_event = asyncio.Event()
-    buffer_lock = asyncio.Lock() # Local lock for this connection's buffer
+    new_audio = asyncio.Event() # Set by the receiver after every ring write
+
+    def recent_peak(end, count):
+        # Peak |x| over the buckets covering the `count` samples ending at `end`
+        first = (end - count) // bucket_samples
+        last = (end - 1) // bucket_samples
+        return max(bucket_max[b % n_buckets] for b in range(first, last + 1))
+
+    def write_samples(src):
+        # Ring write: split at the ring end and at bucket boundaries, then one
+        # fused pass per piece converts, scales and measures its peak
+        if len(src) > buffer_capacity:
+            state["total_samples"] += len(src) - buffer_capacity
+            src = src[-buffer_capacity:]
+            bucket_max[:] = 0
+        # Publish the new end before touching the samples, so a worker copying
+        # a window that this write laps is guaranteed to see it
+        ring_written[0] = state["total_samples"] + len(src)
+        pos = 0
+        while pos < len(src):
+            total = state["total_samples"]
+            idx = total % buffer_capacity
+            offset = total % bucket_samples
+            take = min(len(src) - pos, buffer_capacity - idx, bucket_samples - offset)
+            peak = _ingest(src[pos : pos + take], audio_buffer[idx : idx + take], INV_32768)
+            slot = total // bucket_samples % n_buckets
+            if offset == 0 or peak > bucket_max[slot]:
+                bucket_max[slot] = peak # A new bucket starts from scratch
+            state["total_samples"] = total + take
+            pos += take
+
+    async def transcribe_window(end, count, beam_size=1, timeout=None):
+        # Transcribe the `count` samples ending at absolute index `end`. Returns
+        # None if the window was overwritten before the worker copied it, the
+        # worker died, or `timeout` seconds passed (a job that already started
+        # still finishes; its result is ignored). Each connection awaits its
+        # own window before submitting the next, so nothing queues up behind it.
+        executor = TRANSCRIBE_EXEC
+        try:
+            result, torn = await asyncio.wait_for(asyncio.wrap_future(executor.submit(
+                transcribe_shared, shm.name, buffer_capacity, end - count,
+                count, beam_size
+            )), timeout)
+        except BrokenProcessPool:
+            restart_executor(executor)
+            return None
+        except asyncio.TimeoutError:
+            return None
+        if torn:
+            print("[TRANSCRIPTION] Window overwritten before it was read, dropped")
+            return None
+        return result
 
     async def run_transcriber():
-        last_transcribe_time = time.time()
+        loop = asyncio.get_running_loop()
+        stride_samples = int(STRIDE_SECONDS * SAMPLE_RATE)
+        last_transcribe_time = loop.time() # Monotonic, for rate-limiting only
+        last_transcribe_total = 0
+        # Smoothed decode latency: the stride stretches to stay ahead of it
+        ewma_latency = 0.0
         # Track the last valid text to "commit" it when silence occurs
         last_committed_text = ""
         last_interim_text = "" 
+        # Where the audio behind last_interim_text sits in the ring
+        last_speech_end = 0
+        last_speech_count = 0
+        # End of the last window that went through interim transcription
+        last_window_end = 0
         
         print("[TRANSCRIPTION] Task started")
         
         while not stop_event.is_set():
             try:
-                now = time.time()
-                if now - last_transcribe_time < STRIDE_SECONDS:
-                    await asyncio.sleep(0.05) # Check frequently for stop
+                # Sleep until the receiver writes; no polling while idle
+                await new_audio.wait()
+                new_audio.clear()
+                if stop_event.is_set():
+                    break
+                if state["total_samples"] - last_transcribe_total < stride_samples:
                     continue
-                
-                if model is None:
-                    await asyncio.sleep(0.5)
+                if loop.time() - last_transcribe_time < max(STRIDE_SECONDS, 1.2 * ewma_latency):
                     continue
+                
+                last_transcribe_time = loop.time()
+                last_transcribe_total = state["total_samples"]
+                now = time.time() # Wall clock, sent to the client
 
-                last_transcribe_time = now
-
-                # 1. Snapshot Audio (Critical Section)
-                segment_to_process = None
+                # 1. Snapshot Audio
+                total = state["total_samples"]
                 
-                async with buffer_lock:
-                    ptr = state["buffer_ptr"]
-                    
-                    # Logic needs to match previous: Pull last WINDOW_SECONDS
-                    window_samples_count = int(WINDOW_SECONDS * SAMPLE_RATE)
-                    
-                    if ptr >= window_samples_count:
-                         # Simple case: we have enough contiguous data at the end
-                         segment_to_process = audio_buffer[ptr - window_samples_count : ptr].copy()
-                    else:
-                        # Not enough data yet 
-                        # Wait for at least 1.0s
-                        if ptr < SAMPLE_RATE * 1.0:
-                            continue
-                        segment_to_process = audio_buffer[:ptr].copy()
-
-                if segment_to_process is None:
+                # Logic needs to match previous: Pull last WINDOW_SECONDS
+                window_samples_count = int(WINDOW_SECONDS * SAMPLE_RATE)
+                
+                # Not enough data yet 
+                # Wait for at least 1.0s
+                if total < SAMPLE_RATE * 1.0:
                     continue
+                
+                # Only indices cross to the worker; the audio stays in shared memory
+                window_count = min(total, window_samples_count)
 
                 # 2. Silence Detection & Finalization Logic
-                max_amp = np.max(np.abs(segment_to_process))
+                max_amp = recent_peak(total, window_count)
                 
                 # If SILENCE detected
-                if max_amp < 0.01:
+                if max_amp < SILENCE_THRESHOLD:
                     # If we had some text pending that hasn't been committed yet, commit it now.
                     if last_interim_text and last_interim_text != last_committed_text:
-                        print(f"[TRANSCRIPTION] Silence detected. Committing: '{last_interim_text}'")
+                        final_text = last_interim_text
+                        # Re-decode the last speech window with beam search. This delays
+                        # the commit by one beam decode, so wait no longer than the ring
+                        # keeps that window; past that, commit the interim text as is.
+                        margin = (
+                            last_speech_end - last_speech_count + buffer_capacity - state["total_samples"]
+                        ) / SAMPLE_RATE
+                        if margin > 0:
+                            result = await transcribe_window(
+                                last_speech_end, last_speech_count, BEAM_SIZE, timeout=margin
+                            )
+                            if result:
+                                final_text = result
+                            elif result is None:
+                                print("[TRANSCRIPTION] Beam re-decode unavailable, committing interim text")
+                        print(f"[TRANSCRIPTION] Silence detected. Committing: '{final_text}'")
                         if not stop_event.is_set():
-                            await websocket.send_json({
+                            await websocket.send_bytes(orjson.dumps({
                                 "type": "segment_final",
-                                "text": last_interim_text,
+                                "text": final_text,
                                 "timestamp": now
-                            })
-                        last_committed_text = last_interim_text
+                            }))
+                        last_committed_text = final_text
                         last_interim_text = "" # Reset interim
                         
                     continue # Skip transcription on silence
 
+                # Only a pause mid-utterance since the last window: the decode would
+                # repeat the previous result, so keep last_interim_text
+                new_samples = min(total - last_window_end, window_count)
+                if last_interim_text and recent_peak(total, new_samples) < TAIL_SILENCE_THRESHOLD:
+                    continue
+
                 # 3. CPU Bound Transcription (run in executor)
-                # If not silent, we transcribe
-                loop = asyncio.get_running_loop()
-                result = await loop.run_in_executor(None, transcribe_sync, segment_to_process)
+                # If not silent, we transcribe (greedy: interim only)
+                t_submit = loop.time()
+                result = await transcribe_window(total, window_count)
+                ewma_latency = 0.9 * ewma_latency + 0.1 * (loop.time() - t_submit)
+                if result is None:
+                    continue
+                last_window_end = total
                 
                 # Update partial tracking
                 if result:
                     last_interim_text = result
+                    last_speech_end = total
+                    last_speech_count = window_count
                 
                 # 4. Send Result (Partial Update)
                 if not stop_event.is_set():
                     try:
-                        await websocket.send_json({
+                        await websocket.send_bytes(orjson.dumps({
                             "type": "window_update",
                             "text": result,
                             "timestamp": now
-                        })
+                        }))
                     except Exception as e:
                         print(f"[TRANSCRIPTION] Send failed (stopping): {e}")
                         stop_event.set()
@@ -196,6 +439,7 @@ async def websocket_endpoint(websocket: WebSocket):
 
     # Start Transcriber
     transcriber_task = asyncio.create_task(run_transcriber())
+    carry = b"" # Odd trailing byte, completed by the next frame
 
     try:
         while True:
@@ -205,30 +449,13 @@ async def websocket_endpoint(websocket: WebSocket):
                 print("[RECEIVER] Disconnect received")
                 break
             
-            if "bytes" in message and is_running:
-                chunk_bytes = message["bytes"]
-                # Convert
-                chunk_np = np.frombuffer(chunk_bytes, dtype=np.int16).astype(np.float32) / 32768.0
-                chunk_len = len(chunk_np)
-                
-                async with buffer_lock:
-                    ptr = state["buffer_ptr"]
-                    
-                    # Overflow check (Shift Buffer Strategy)
-                    if ptr + chunk_len > buffer_capacity:
-                        # Keep last 5 seconds (2x Window)
-                        keep_samples = int(WINDOW_SECONDS * 2 * SAMPLE_RATE)
-                        if keep_samples > ptr: keep_samples = ptr
-                        
-                        # Shift
-                        audio_buffer[:keep_samples] = audio_buffer[ptr - keep_samples : ptr]
-                        state["buffer_ptr"] = keep_samples
-                        ptr = keep_samples # Update local var for next line use
-                    
-                    # Write
-                    audio_buffer[ptr : ptr + chunk_len] = chunk_np
-                    state["buffer_ptr"] += chunk_len
-                    state["total_samples"] += chunk_len
+            if message.get("bytes") and is_running:
+                chunk_bytes = carry + message["bytes"] if carry else message["bytes"]
+                usable = len(chunk_bytes) & ~1 # Whole int16 samples only
+                carry = chunk_bytes[usable:]
+                # Zero-copy int16 view; scaled straight into the ring
+                write_samples(np.frombuffer(chunk_bytes, dtype=np.int16, count=usable // 2))
+                new_audio.set()
                     
     except WebSocketDisconnect:
         print("[RECEIVER] WebSocketDisconnect exception")
@@ -237,7 +464,11 @@ async def websocket_endpoint(websocket: WebSocket):
     finally:
         print("[BACKEND] WebSocket cleaning up...")
         stop_event.set() # Signal transcriber to stop
+        new_audio.set() # Wake it if it is waiting for audio
         await transcriber_task # Wait for it to exit
+        del audio_buffer, ring_written # Views must go before the mapping is closed
+        shm.close()
+        shm.unlink()
         print("[BACKEND] WebSocket closed completely")
 
 if __name__ == "__main__":
@@ -14,6 +14,8 @@ export class WebSocketClient {
     this.reconnectAttempts = 0
     this.maxReconnectAttempts = 10
     this.reconnectDelay = 3000
+    // Backend sends JSON as binary frames (pre-encoded UTF-8)
+    this.decoder = new TextDecoder()
 
     this.onConnect = config.onConnect || (() => { })
     this.onDisconnect = config.onDisconnect || (() => { })
@@ -32,6 +34,7 @@ export class WebSocketClient {
 
     try {
       this.ws = new WebSocket(this.url)
+      this.ws.binaryType = "arraybuffer"
 
       this.ws.onopen = () => {
         console.log("[LiveSpeak] WebSocket connected")
@@ -42,7 +45,8 @@ export class WebSocketClient {
 
       this.ws.onmessage = (event) => {
         try {
-          const message = JSON.parse(event.data)
+          const text = typeof event.data === "string" ? event.data : this.decoder.decode(event.data)
+          const message = JSON.parse(text)
           this.onMessage(message)
         } catch (e) {
           console.error("[LiveSpeak] Failed to parse WebSocket message:", e)